@@ -1,15 +1,35 @@
-from fastapi import FastAPI, HTTPException, Form, UploadFile, File
-from fastapi.responses import PlainTextResponse
-from pydantic import BaseModel, field_validator
-from typing import List, Optional, Dict
+from fastapi import FastAPI, HTTPException, Form, UploadFile, File, BackgroundTasks
+from fastapi.responses import PlainTextResponse, JSONResponse, Response
+from pydantic import BaseModel, TypeAdapter, field_validator
+from typing import List, Optional, Dict, Tuple
+from collections import defaultdict, OrderedDict, Counter
+import aiosqlite
+import redis.asyncio as redis
 import africastalking
+import africastalking.Service as africastalking_service
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 from dotenv import load_dotenv
 import logging
+import orjson
 import csv
 import io
+import re
+import sys
 from datetime import datetime
+from array import array
+import math
+from bisect import bisect_left, insort
+import heapq
+from functools import lru_cache
 import uuid
+import time
+import asyncio
+import threading
+import anyio
+import anyio.to_thread
 
 # Load environment variables
 load_dotenv()
@@ -18,11 +38,19 @@ load_dotenv()
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+class ORJSONResponse(JSONResponse):
+    """JSON response rendered by orjson (native serializer, emits bytes directly)"""
+    
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, option=orjson.OPT_NON_STR_KEYS)
+
+
 # Initialize FastAPI app
 app = FastAPI(
     title="KASA - Local Alert & Notification System",
     description="A FastAPI backend for sending SMS alerts and handling USSD menus",
-    version="1.0.0"
+    version="1.0.0",
+    default_response_class=ORJSONResponse
 )
 
 # Africa's Talking configuration
@@ -46,6 +74,93 @@ africastalking.initialize(AFRICAS_TALKING_USERNAME, AFRICAS_TALKING_API_KEY)
 # Get SMS service
 sms = africastalking.SMS
 
+# Static JSON bodies, serialized once (configuration is fixed for the life of the process)
+HEALTH_BYTES = orjson.dumps({
+    "status": "healthy",
+    "service": "KASA Alert System",
+    "timestamp": "2025-06-27",
+    "africas_talking": "configured" if AFRICAS_TALKING_USERNAME else "not_configured"
+})
+
+CREDENTIALS_BYTES = orjson.dumps({
+    "username": AFRICAS_TALKING_USERNAME,
+    "api_key_preview": f"{AFRICAS_TALKING_API_KEY[:10]}..." if AFRICAS_TALKING_API_KEY else "None",
+    "sender_id": AFRICAS_TALKING_SENDER_ID,
+    "credentials_loaded": bool(AFRICAS_TALKING_USERNAME and AFRICAS_TALKING_API_KEY)
+})
+
+SMS_CREDENTIALS_BYTES = orjson.dumps({
+    "status": "success",
+    "message": "SMS credentials are valid",
+    "config": {
+        "username": AFRICAS_TALKING_USERNAME,
+        "api_key_configured": bool(AFRICAS_TALKING_API_KEY),
+        "sender_id": AFRICAS_TALKING_SENDER_ID,
+        "environment": "sandbox" if AFRICAS_TALKING_USERNAME == "sandbox" else "production"
+    },
+    "sandbox_info": {
+        "note": "For sandbox testing, use test numbers from your dashboard",
+        "common_test_formats": ["+254711XXXXXX", "+254733XXXXXX"],
+        "dashboard_url": "https://account.africastalking.com/"
+    }
+})
+
+# Bulk SMS batching (Africa's Talking accepts up to 1000 recipients per request)
+SMS_BATCH_SIZE = int(os.getenv("SMS_BATCH_SIZE", "1000"))
+SMS_MAX_CONCURRENT_BATCHES = 8
+
+# Cap on worker threads blocked in the SMS SDK across all requests
+SMS_MAX_THREADS = int(os.getenv("SMS_MAX_THREADS", "16"))
+sms_thread_limiter: Optional[anyio.CapacityLimiter] = None
+
+
+@app.on_event("startup")
+async def open_sms_http_session():
+    """Route the Africa's Talking SDK through one pooled keep-alive HTTP session"""
+    # The SDK calls requests.get/post directly, opening a new TLS connection per send
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=2,  # api. and content. hosts
+        pool_maxsize=SMS_MAX_THREADS,  # one connection per concurrent SMS thread
+        max_retries=Retry(total=2, backoff_factor=0.2)
+    )
+    session.mount("https://", adapter)
+    africastalking_service.requests = session
+    logger.info(f"SMS HTTP session ready (pool size {SMS_MAX_THREADS})")
+
+
+@app.on_event("shutdown")
+async def close_sms_http_session():
+    """Close the pooled SDK session and restore the plain requests module"""
+    session = africastalking_service.requests
+    if isinstance(session, requests.Session):
+        africastalking_service.requests = requests
+        session.close()
+
+
+# International format phone number: '+' followed by 9-15 digits (match with fullmatch)
+PHONE_NUMBER_PATTERN = re.compile(r"\+\d{9,15}")
+NON_DIGITS_PATTERN = re.compile(r"\D")
+DEFAULT_COUNTRY_CODE = "254"
+
+
+def canonical_phone(phone_number: str) -> str:
+    """
+    Normalize a phone number to +<country code><subscriber> and intern it, so every
+    dict keyed by phone shares one string object (e.g. '0712 345 678' -> '+254712345678')
+    """
+    digits = NON_DIGITS_PATTERN.sub("", phone_number)
+    if not digits:
+        return phone_number
+    if phone_number.lstrip().startswith("+"):
+        # Already international; only the formatting is dropped
+        return sys.intern("+" + digits)
+    if digits.startswith("0"):
+        digits = DEFAULT_COUNTRY_CODE + digits[1:]
+    elif len(digits) == 9:
+        digits = DEFAULT_COUNTRY_CODE + digits
+    return sys.intern("+" + digits)
+
 
 # Pydantic models for request validation
 class AlertRequest(BaseModel):
@@ -67,12 +182,11 @@ class AlertRequest(BaseModel):
         if not v:
             raise ValueError('Recipients list cannot be empty')
         
-        # Basic phone number validation for African numbers
-        for phone in v:
-            if not phone.startswith('+'):
-                raise ValueError(f'Phone number {phone} must include country code (e.g., +254...)')
-            if len(phone) < 10:
-                raise ValueError(f'Phone number {phone} appears to be too short')
+        # Phone number validation for African numbers (international format)
+        invalid = [phone for phone in v if not PHONE_NUMBER_PATTERN.fullmatch(phone)]
+        if invalid:
+            raise ValueError(f"Invalid phone number(s): {', '.join(invalid)}. "
+                             f"Use international format with country code (e.g., +254712345678)")
         
         return v
 
@@ -98,6 +212,10 @@ class User(BaseModel):
         super().__init__(**data)
 
 
+# Validates a batch of users in one call (bulk CSV import)
+USER_LIST_ADAPTER = TypeAdapter(List[User])
+
+
 class EmergencyReport(BaseModel):
     session_id: str
     phone_number: str
@@ -108,30 +226,166 @@ class EmergencyReport(BaseModel):
     status: str = "pending"
 
 
+# USSD session limits (gateways drop idle USSD sessions after a few minutes)
+USSD_SESSION_TTL_SECONDS = 180
+USSD_SESSION_MAX_SIZE = 100_000
+USSD_SESSION_SWEEP_BATCH = 32
+USSD_SESSION_SHARDS = 64
+
+
 class USSDSessionState:
-    """Manages USSD session states for multi-step flows"""
+    """
+    Manages USSD session states for multi-step flows.
+    Sessions are spread over shards, each with its own asyncio lock so sessions on different
+    shards never serialize; each shard is LRU-bounded with idle expiry.
+    """
     
-    def __init__(self):
-        self.sessions: Dict[str, Dict] = {}
+    def __init__(self, max_size: int = USSD_SESSION_MAX_SIZE, ttl_seconds: float = USSD_SESSION_TTL_SECONDS,
+                 shard_count: int = USSD_SESSION_SHARDS):
+        # Per shard: session_id -> (data, expires_at), least recently used first
+        self.shards: List["OrderedDict[str, Tuple[Dict, float]]"] = [OrderedDict() for _ in range(shard_count)]
+        self.locks = [asyncio.Lock() for _ in range(shard_count)]
+        self.shard_max_size = max(1, max_size // shard_count)
+        self.ttl_seconds = ttl_seconds
+    
+    def shard_for(self, session_id: str) -> "OrderedDict[str, Tuple[Dict, float]]":
+        """Get the shard holding a session ID"""
+        return self.shards[hash(session_id) % len(self.shards)]
+    
+    def lock_for(self, session_id: str) -> asyncio.Lock:
+        """Get the lock guarding a session ID's shard"""
+        return self.locks[hash(session_id) % len(self.locks)]
+    
+    def _touch(self, shard: OrderedDict, session_id: str, data: Dict):
+        """Store session data as most recently used and push back its expiry"""
+        shard[session_id] = (data, time.monotonic() + self.ttl_seconds)
+        shard.move_to_end(session_id)
+    
+    def _evict(self, shard: OrderedDict):
+        """Sweep expired sessions from the LRU end and enforce the shard size cap"""
+        now = time.monotonic()
+        for _ in range(USSD_SESSION_SWEEP_BATCH):
+            if not shard:
+                break
+            _, expires_at = next(iter(shard.values()))
+            if expires_at > now:
+                break
+            shard.popitem(last=False)
+        while len(shard) > self.shard_max_size:
+            shard.popitem(last=False)
     
-    def get_session(self, session_id: str) -> Dict:
+    def _get(self, shard: OrderedDict, session_id: str) -> Dict:
+        """Read live session data from a shard (caller holds the shard lock)"""
+        entry = shard.get(session_id)
+        if entry is None:
+            return {}
+        data, expires_at = entry
+        if time.monotonic() > expires_at:
+            del shard[session_id]
+            return {}
+        self._touch(shard, session_id, data)
+        return data
+    
+    async def get_session(self, session_id: str) -> Dict:
         """Get session data for a session ID"""
-        return self.sessions.get(session_id, {})
+        async with self.lock_for(session_id):
+            return self._get(self.shard_for(session_id), session_id)
     
-    def set_session(self, session_id: str, data: Dict):
+    async def set_session(self, session_id: str, data: Dict):
         """Set session data for a session ID"""
-        self.sessions[session_id] = data
+        shard = self.shard_for(session_id)
+        async with self.lock_for(session_id):
+            self._touch(shard, session_id, data)
+            self._evict(shard)
     
-    def clear_session(self, session_id: str):
+    async def clear_session(self, session_id: str):
         """Clear session data for a session ID"""
-        if session_id in self.sessions:
-            del self.sessions[session_id]
+        async with self.lock_for(session_id):
+            self.shard_for(session_id).pop(session_id, None)
+    
+    async def update_session(self, session_id: str, values: Dict):
+        """Update keys in session data as one atomic step (one lock acquisition)"""
+        shard = self.shard_for(session_id)
+        async with self.lock_for(session_id):
+            data = self._get(shard, session_id)
+            data.update(values)
+            self._touch(shard, session_id, data)
+            self._evict(shard)
+
+
+class RedisUSSDSessionState:
+    """Manages USSD session states in Redis hashes with native expiry, shared by all workers"""
+    
+    def __init__(self, client: redis.Redis, ttl_seconds: int = USSD_SESSION_TTL_SECONDS):
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+    
+    @staticmethod
+    def _key(session_id: str) -> str:
+        return f"ussd:{session_id}"
+    
+    async def get_session(self, session_id: str) -> Dict:
+        """Get session data for a session ID, refreshing its idle expiry in the same round-trip"""
+        redis_key = self._key(session_id)
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.hgetall(redis_key)
+            pipe.expire(redis_key, self.ttl_seconds)
+            fields, _ = await pipe.execute()
+        return {field: orjson.loads(value) for field, value in fields.items()}
+    
+    async def set_session(self, session_id: str, data: Dict):
+        """Set session data for a session ID"""
+        redis_key = self._key(session_id)
+        async with self.client.pipeline(transaction=True) as pipe:
+            pipe.delete(redis_key)
+            if data:
+                pipe.hset(redis_key, mapping={field: orjson.dumps(value) for field, value in data.items()})
+                pipe.expire(redis_key, self.ttl_seconds)
+            await pipe.execute()
     
-    def update_session(self, session_id: str, key: str, value):
-        """Update a specific key in session data"""
-        if session_id not in self.sessions:
-            self.sessions[session_id] = {}
-        self.sessions[session_id][key] = value
+    async def clear_session(self, session_id: str):
+        """Clear session data for a session ID"""
+        await self.client.delete(self._key(session_id))
+    
+    async def update_session(self, session_id: str, values: Dict):
+        """Update keys in session data (single HSET + EXPIRE round-trip)"""
+        redis_key = self._key(session_id)
+        async with self.client.pipeline(transaction=False) as pipe:
+            pipe.hset(redis_key, mapping={field: orjson.dumps(value) for field, value in values.items()})
+            pipe.expire(redis_key, self.ttl_seconds)
+            await pipe.execute()
+
+
+# Static USSD screens (built once, served on every request)
+MAIN_MENU = ("CON Welcome to KASA - Local Alert System\n"
+             "1. Send Emergency Alert\n"
+             "2. Register User\n"
+             "3. View System Status\n"
+             "4. Help\n"
+             "0. Exit")
+
+EMERGENCY_MENU = ("CON Select Emergency Type:\n"
+                  "1. Fire Emergency\n"
+                  "2. Medical Emergency\n"
+                  "3. Security Alert\n"
+                  "4. Natural Disaster\n"
+                  "0. Back to Main Menu")
+
+HELP_MENU = ("CON KASA Help:\n"
+             "- Dial this code to send alerts\n"
+             "- Alerts are sent to registered contacts\n"
+             "- For emergencies, call 999\n"
+             "0. Back to Main Menu")
+
+REGISTRATION_NAME_PROMPT = "CON Enter your full name:"
+
+# Emergency menu option -> emergency type
+EMERGENCY_TYPES = {
+    '1': 'Fire Emergency',
+    '2': 'Medical Emergency',
+    '3': 'Security Alert',
+    '4': 'Natural Disaster'
+}
 
 
 class USSDSession:
@@ -139,21 +393,11 @@ class USSDSession:
     
     @staticmethod
     def get_main_menu():
-        return ("CON Welcome to KASA - Local Alert System\n"
-                "1. Send Emergency Alert\n"
-                "2. Register User\n"
-                "3. View System Status\n"
-                "4. Help\n"
-                "0. Exit")
+        return MAIN_MENU
     
     @staticmethod
     def get_emergency_menu():
-        return ("CON Select Emergency Type:\n"
-                "1. Fire Emergency\n"
-                "2. Medical Emergency\n"
-                "3. Security Alert\n"
-                "4. Natural Disaster\n"
-                "0. Back to Main Menu")
+        return EMERGENCY_MENU
     
     @staticmethod
     def get_confirmation_menu(alert_type: str):
@@ -161,76 +405,357 @@ class USSDSession:
     
     @staticmethod
     def get_help_menu():
-        return ("CON KASA Help:\n"
-                "- Dial this code to send alerts\n"
-                "- Alerts are sent to registered contacts\n"
-                "- For emergencies, call 999\n"
-                "0. Back to Main Menu")
+        return HELP_MENU
     
     @staticmethod
     def get_registration_name_prompt():
-        return "CON Enter your full name:"
+        return REGISTRATION_NAME_PROMPT
     
+    # Prompts are pure functions of their inputs; cached for repeat/invalid-option hops
     @staticmethod
+    @lru_cache(maxsize=4096)
     def get_registration_location_prompt(name: str):
         return f"CON Hello {name}!\nEnter your location/area:"
     
     @staticmethod
+    @lru_cache(maxsize=4096)
     def get_registration_confirmation(name: str, location: str):
         return f"CON Confirm registration:\nName: {name}\nLocation: {location}\n1. Confirm\n2. Cancel\n0. Main Menu"
 
 
-# In-memory storage for emergency reports and users (use database in production)
-emergency_reports = {}
+class EmergencyReportTable:
+    """
+    Emergency reports stored column-wise: a list per text field and float arrays for
+    coordinates, addressed by row through reference_id. Filters and ordering read single
+    columns; dicts are built only for the rows on the requested dashboard page.
+    """
+    
+    def __init__(self):
+        self.rows: Dict[str, int] = {}  # reference_id -> row
+        self.reference_ids: List[str] = []
+        self.phone_numbers: List[str] = []
+        self.emergency_types: List[str] = []
+        self.timestamps: List[str] = []
+        self.statuses: List[str] = []
+        self.addresses: List[Optional[str]] = []
+        self.landmarks: List[Optional[str]] = []
+        self.cell_tower_ids: List[Optional[str]] = []
+        self.network_providers: List[Optional[str]] = []
+        self.latitudes = array("d")  # NaN when unknown
+        self.longitudes = array("d")
+    
+    def __len__(self) -> int:
+        return len(self.reference_ids)
+    
+    def upsert(self, report: EmergencyReport) -> int:
+        """Write a report into its existing row or append a new one; returns the row"""
+        location = report.location
+        values = (
+            (self.reference_ids, report.reference_id),
+            (self.phone_numbers, report.phone_number),
+            (self.emergency_types, report.emergency_type),
+            (self.timestamps, report.timestamp),
+            (self.statuses, report.status),
+            (self.addresses, location.address),
+            (self.landmarks, location.landmark),
+            (self.cell_tower_ids, location.cell_tower_id),
+            (self.network_providers, location.network_provider),
+            (self.latitudes, math.nan if location.latitude is None else location.latitude),
+            (self.longitudes, math.nan if location.longitude is None else location.longitude),
+        )
+        row = self.rows.get(report.reference_id)
+        if row is None:
+            row = len(self.reference_ids)
+            self.rows[report.reference_id] = row
+            for column, value in values:
+                column.append(value)
+        else:
+            for column, value in values:
+                column[row] = value
+        return row
+    
+    def timestamp_of(self, reference_id: str) -> str:
+        return self.timestamps[self.rows[reference_id]]
+    
+    def report_dict(self, reference_id: str) -> Dict:
+        """Serialize one report for the dashboard"""
+        row = self.rows[reference_id]
+        latitude = None if math.isnan(self.latitudes[row]) else self.latitudes[row]
+        longitude = None if math.isnan(self.longitudes[row]) else self.longitudes[row]
+        return {
+            "reference_id": self.reference_ids[row],
+            "emergency_type": self.emergency_types[row],
+            "phone_number": self.phone_numbers[row],
+            "timestamp": self.timestamps[row],
+            "location": {
+                "address": self.addresses[row],
+                "landmark": self.landmarks[row],
+                "latitude": latitude,
+                "longitude": longitude,
+                "cell_tower": self.cell_tower_ids[row],
+                "network": self.network_providers[row],
+                "maps_link": f"https://maps.google.com/?q={latitude},{longitude}" if latitude and longitude else None
+            },
+            "status": self.statuses[row]
+        }
+
+
+# In-memory storage for emergency reports and users (served from memory, persisted to SQLite when enabled)
+emergency_reports = EmergencyReportTable()
 users_db: Dict[str, User] = {}  # phone_number -> User object
+users_by_location_idx: Dict[str, List[User]] = defaultdict(list)  # location.lower() -> users
+location_counts: Counter = Counter()  # location -> number of registered users
+users_json_cache: Dict[str, Dict] = {}  # phone_number -> serialized user, built once at registration
+
+# Dashboard indexes over emergency reports so filters and paging avoid full scans
+reports_by_status: Dict[str, set] = defaultdict(set)  # status -> reference_ids
+reports_by_location_key: Dict[str, set] = defaultdict(set)  # lowercase address -> reference_ids
+reports_timeline: List[Tuple[str, str]] = []  # (timestamp, reference_id), kept sorted
+
+
+class ShardedDict:
+    """
+    Dict split over shards, each guarded by its own lock, so writers on different
+    shards (event loop or threadpool) never contend and readers never see a torn update.
+    """
+    
+    def __init__(self, shards: int = 32):
+        self.shards: List[Dict] = [{} for _ in range(shards)]
+        self.locks = [threading.Lock() for _ in range(shards)]
+    
+    def _index(self, key: str) -> int:
+        return hash(key) % len(self.shards)
+    
+    def get(self, key: str, default=None):
+        index = self._index(key)
+        with self.locks[index]:
+            return self.shards[index].get(key, default)
+    
+    def set(self, key: str, value):
+        index = self._index(key)
+        with self.locks[index]:
+            self.shards[index][key] = value
+    
+    def pop(self, key: str, default=None):
+        index = self._index(key)
+        with self.locks[index]:
+            return self.shards[index].pop(key, default)
+    
+    def __len__(self) -> int:
+        return sum(len(shard) for shard in self.shards)
+
+
+# Locations registered through /register-location (phone_number -> LocationInfo)
+USER_LOCATIONS = ShardedDict(shards=32)
+
+# Optional SQLite persistence (set KASA_DB_PATH, e.g. kasa.db, to enable)
+KASA_DB_PATH = os.getenv("KASA_DB_PATH")
+db: Optional[aiosqlite.Connection] = None
+
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    phone_number TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    location TEXT NOT NULL,
+    registration_date TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_users_location ON users (location COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS emergency_reports (
+    reference_id TEXT PRIMARY KEY,
+    session_id TEXT NOT NULL,
+    phone_number TEXT NOT NULL,
+    emergency_type TEXT NOT NULL,
+    timestamp TEXT NOT NULL,
+    location TEXT NOT NULL,
+    status TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_emergency_reports_phone ON emergency_reports (phone_number);
+"""
+
+
+@app.on_event("startup")
+async def open_database():
+    """Open the SQLite store and load persisted users and reports into memory"""
+    global db
+    if not KASA_DB_PATH:
+        logger.info("KASA_DB_PATH not set, using in-memory storage only")
+        return
+    
+    db = await aiosqlite.connect(KASA_DB_PATH)
+    await db.execute("PRAGMA journal_mode=WAL")
+    await db.execute("PRAGMA synchronous=NORMAL")
+    await db.executescript(DB_SCHEMA)
+    await db.commit()
+    
+    async with db.execute("SELECT phone_number, name, location, registration_date FROM users") as cursor:
+        async for phone_number, name, location, registration_date in cursor:
+            user = User(phone_number=phone_number, name=name, location=location,
+                        registration_date=registration_date)
+            store_user(user)
+    
+    async with db.execute(
+        "SELECT reference_id, session_id, phone_number, emergency_type, timestamp, location, status "
+        "FROM emergency_reports ORDER BY timestamp"
+    ) as cursor:
+        async for reference_id, session_id, phone_number, emergency_type, timestamp, location, status in cursor:
+            store_emergency_report(EmergencyReport(
+                session_id=session_id,
+                phone_number=canonical_phone(phone_number),
+                emergency_type=emergency_type,
+                timestamp=timestamp,
+                location=LocationInfo.model_validate_json(location),
+                reference_id=reference_id,
+                status=status
+            ))
+    
+    logger.info(f"Loaded {len(users_db)} users and {len(emergency_reports)} emergency reports from {KASA_DB_PATH}")
 
-# Initialize USSD session manager
+
+@app.on_event("shutdown")
+async def close_database():
+    """Close the SQLite store"""
+    global db
+    if db is not None:
+        await db.close()
+        db = None
+
+
+async def save_user(user: User):
+    """Persist a user record (no-op without a database)"""
+    if db is None:
+        return
+    await db.execute(
+        "INSERT OR REPLACE INTO users (phone_number, name, location, registration_date) VALUES (?, ?, ?, ?)",
+        (user.phone_number, user.name, user.location, user.registration_date)
+    )
+    await db.commit()
+
+
+async def save_users(users: List[User]):
+    """Persist a batch of user records in one transaction (no-op without a database)"""
+    if db is None:
+        return
+    await db.executemany(
+        "INSERT OR REPLACE INTO users (phone_number, name, location, registration_date) VALUES (?, ?, ?, ?)",
+        [(user.phone_number, user.name, user.location, user.registration_date) for user in users]
+    )
+    await db.commit()
+
+
+async def save_emergency_report(report: EmergencyReport):
+    """Persist an emergency report (no-op without a database)"""
+    if db is None:
+        return
+    await db.execute(
+        "INSERT OR REPLACE INTO emergency_reports "
+        "(reference_id, session_id, phone_number, emergency_type, timestamp, location, status) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (report.reference_id, report.session_id, report.phone_number, report.emergency_type,
+         report.timestamp, report.location.model_dump_json(), report.status)
+    )
+    await db.commit()
+
+# Initialize USSD session manager (in-memory per process; Redis when REDIS_URL is set)
 ussd_session_manager = USSDSessionState()
 
+# Shared session store for multi-worker deployments
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "32"))  # concurrent USSD requests per worker
+redis_client: Optional[redis.Redis] = None
+
+
+@app.on_event("startup")
+async def open_session_store():
+    """Move USSD session state to Redis when configured"""
+    global ussd_session_manager, redis_client
+    if not REDIS_URL:
+        return
+    redis_client = redis.Redis.from_url(REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS, decode_responses=True)
+    await redis_client.ping()
+    ussd_session_manager = RedisUSSDSessionState(redis_client)
+    logger.info(f"USSD sessions stored in Redis (pool size {REDIS_MAX_CONNECTIONS})")
+
+
+@app.on_event("shutdown")
+async def close_session_store():
+    """Close the Redis connection pool"""
+    global redis_client
+    if redis_client is not None:
+        await redis_client.aclose()
+        redis_client = None
+
 
 # Location tracking functionality
+class PhonePrefixTrie:
+    """Character trie mapping phone number prefixes to values with longest-prefix lookup"""
+    
+    def __init__(self):
+        self.root: Dict = {}
+    
+    def insert(self, prefix: str, value):
+        """Store a value under a phone number prefix"""
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[None] = value
+    
+    def longest_match(self, phone_number: str):
+        """Return the value of the longest stored prefix of phone_number, or None"""
+        node = self.root
+        match = node.get(None)
+        for char in phone_number:
+            node = node.get(char)
+            if node is None:
+                break
+            match = node.get(None, match)
+        return match
+
+
+# Simulated cell tower locations keyed by phone number prefix
+LOCATION_PREFIXES = {
+    "+254711": LocationInfo(
+        latitude=-1.2921,
+        longitude=36.8219,
+        address="Nairobi Central Business District",
+        landmark="Near Kenyatta Avenue",
+        cell_tower_id="NRB_001",
+        network_provider="Safaricom"
+    ),
+    "+254712": LocationInfo(
+        latitude=-1.3032,
+        longitude=36.7073,
+        address="Westlands, Nairobi", 
+        landmark="Near Sarit Centre",
+        cell_tower_id="WLD_002",
+        network_provider="Safaricom"
+    ),
+    "+254720": LocationInfo(
+        latitude=-1.2833,
+        longitude=36.8167,
+        address="Kilimani, Nairobi",
+        landmark="Near Yaya Centre", 
+        cell_tower_id="KLM_003",
+        network_provider="Airtel"
+    )
+}
+
+location_prefix_trie = PhonePrefixTrie()
+for prefix, prefix_location in LOCATION_PREFIXES.items():
+    location_prefix_trie.insert(prefix, prefix_location)
+
+
 def get_location_from_phone(phone_number: str) -> LocationInfo:
     """Get location based on phone number (simulates cell tower triangulation)"""
-    # Debug: Log the phone number being processed
-    logger.info(f"🔍 Processing location for phone number: '{phone_number}'")
-    
-    # Simulate different locations based on phone number patterns
-    location_map = {
-        "+254711": LocationInfo(
-            latitude=-1.2921,
-            longitude=36.8219,
-            address="Nairobi Central Business District",
-            landmark="Near Kenyatta Avenue",
-            cell_tower_id="NRB_001",
-            network_provider="Safaricom"
-        ),
-        "+254712": LocationInfo(
-            latitude=-1.3032,
-            longitude=36.7073,
-            address="Westlands, Nairobi", 
-            landmark="Near Sarit Centre",
-            cell_tower_id="WLD_002",
-            network_provider="Safaricom"
-        ),
-        "+254720": LocationInfo(
-            latitude=-1.2833,
-            longitude=36.8167,
-            address="Kilimani, Nairobi",
-            landmark="Near Yaya Centre", 
-            cell_tower_id="KLM_003",
-            network_provider="Airtel"
-        )
-    }
-    
-    # Find matching location based on phone prefix
-    for prefix, location in location_map.items():
-        logger.info(f"🔍 Checking prefix '{prefix}' against '{phone_number}'")
-        if phone_number.startswith(prefix):
-            logger.info(f"✅ Match found! Using location: {location.address}")
-            return location
+    # Longest matching phone prefix wins
+    location = location_prefix_trie.longest_match(phone_number)
+    if location is not None:
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Location for {phone_number}: {location.address}")
+        return location
     
     # Default location
-    logger.warning(f"⚠️ No location match found for {phone_number}, using default")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"No location match found for {phone_number}, using default")
     return LocationInfo(
         address="Location being determined via cell tower triangulation",
         landmark="Emergency services dispatched",
@@ -253,20 +778,235 @@ def format_location_for_sms(location: LocationInfo) -> str:
 # Helper functions for user management
 def get_users_by_location(location: str) -> List[User]:
     """Get all users in a specific location"""
-    logger.info(f"Getting users for location: {location}")
-    matching_users = []
+    matching_users = list(users_by_location_idx.get(location.lower(), ()))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Found {len(matching_users)} users in {location}")
+    return matching_users
+
+
+def index_user_location(user: User, previous: Optional[User] = None):
+    """Add a user to the location index and counts, replacing the previous entry for the same phone"""
+    if previous is not None:
+        bucket = users_by_location_idx.get(previous.location.lower())
+        if bucket is not None:
+            bucket[:] = [u for u in bucket if u.phone_number != user.phone_number]
+            if not bucket:
+                del users_by_location_idx[previous.location.lower()]
+        location_counts[previous.location] -= 1
+        if location_counts[previous.location] <= 0:
+            del location_counts[previous.location]
+    users_by_location_idx[user.location.lower()].append(user)
+    location_counts[user.location] += 1
+
+
+def user_to_dict(user: User) -> Dict:
+    """Serialize a user for API responses"""
+    return {
+        "name": user.name,
+        "phone": user.phone_number,
+        "location": user.location,
+        "registration_date": user.registration_date
+    }
+
+
+def store_user(user: User):
+    """Put a user in memory: the users table, location index and response cache"""
+    previous = users_db.get(user.phone_number)
+    # Cache first: threadpool readers resolve index entries through users_json_cache
+    users_json_cache[user.phone_number] = user_to_dict(user)
+    users_db[user.phone_number] = user
+    index_user_location(user, previous)
+
+
+def report_location_key(address: Optional[str]) -> str:
+    """Key a report by its (case-insensitive) address for the location index"""
+    return (address or "unknown").lower()
+
+
+def unindex_emergency_report(row: int):
+    """Drop the report stored at a table row from the status, location and time indexes"""
+    reference_id = emergency_reports.reference_ids[row]
+    for index, key in ((reports_by_status, emergency_reports.statuses[row]),
+                       (reports_by_location_key, report_location_key(emergency_reports.addresses[row]))):
+        bucket = index.get(key)
+        if bucket is not None:
+            bucket.discard(reference_id)
+            if not bucket:
+                del index[key]
+    entry = (emergency_reports.timestamps[row], reference_id)
+    position = bisect_left(reports_timeline, entry)
+    if position < len(reports_timeline) and reports_timeline[position] == entry:
+        del reports_timeline[position]
+
+
+def store_emergency_report(report: EmergencyReport):
+    """Put an emergency report in the report table and the report indexes"""
+    previous_row = emergency_reports.rows.get(report.reference_id)
+    if previous_row is not None:
+        unindex_emergency_report(previous_row)
+    emergency_reports.upsert(report)
+    reports_by_status[report.status].add(report.reference_id)
+    reports_by_location_key[report_location_key(report.location.address)].add(report.reference_id)
+    insort(reports_timeline, (report.timestamp, report.reference_id))
+
+
+def query_emergency_reports(status: Optional[str] = None, location: Optional[str] = None,
+                            since: Optional[datetime] = None, limit: int = 100) -> Tuple[int, List[Dict]]:
+    """Return the number of matching reports and the newest `limit` of them, using the report indexes"""
+    since_key = None
+    if since is not None:
+        # Stored timestamps are naive local time
+        if since.tzinfo is not None:
+            since = since.astimezone().replace(tzinfo=None)
+        since_key = since.isoformat()
     
-    for phone, user in users_db.items():
-        if user.location.lower() == location.lower():
-            matching_users.append(user)
+    filters = []
+    if status:
+        filters.append(reports_by_status.get(status, set()))
+    if location:
+        filters.append(reports_by_location_key.get(location.lower(), set()))
     
-    logger.info(f"Found {len(matching_users)} users in {location}")
-    return matching_users
+    if not filters:
+        # Only a time window: slice the sorted timeline
+        start = bisect_left(reports_timeline, (since_key,)) if since_key else 0
+        total = len(reports_timeline) - start
+        window = reports_timeline[max(start, len(reports_timeline) - limit):]
+        return total, [emergency_reports.report_dict(reference_id) for _, reference_id in reversed(window)]
+    
+    filters.sort(key=len)
+    matched = filters[0].intersection(*filters[1:])
+    if since_key:
+        matched = {reference_id for reference_id in matched if emergency_reports.timestamp_of(reference_id) >= since_key}
+    newest = heapq.nlargest(limit, matched, key=emergency_reports.timestamp_of)
+    return len(matched), [emergency_reports.report_dict(reference_id) for reference_id in newest]
+
+
+def send_sms(message: str, recipients: List[str]):
+    """Send one SMS request through Africa's Talking (blocking)"""
+    # Only include sender_id if it's not empty (sandbox doesn't allow custom sender IDs)
+    if AFRICAS_TALKING_SENDER_ID:
+        return sms.send(message, recipients, sender_id=AFRICAS_TALKING_SENDER_ID)
+    return sms.send(message, recipients)
+
+
+def get_sms_thread_limiter() -> anyio.CapacityLimiter:
+    """Get the shared limiter for SMS SDK threads (created inside the running event loop)"""
+    global sms_thread_limiter
+    if sms_thread_limiter is None:
+        sms_thread_limiter = anyio.CapacityLimiter(SMS_MAX_THREADS)
+    return sms_thread_limiter
+
+
+# statusCode given to recipients of a batch that never got a usable gateway reply
+BATCH_FAILURE_CODES = ("BatchError", "InvalidResponse")
+
+
+async def send_sms_in_batches(message: str, recipients: List[str]) -> Dict:
+    """
+    Send an SMS to many recipients in gateway-sized batches dispatched concurrently
+    on worker threads, so the blocking SDK never stalls the event loop.
+    Returns an Africa's Talking style response with the recipients of every batch;
+    recipients of a failed or malformed batch are reported as failed. Raises if no batch succeeds.
+    """
+    batches = [recipients[i:i + SMS_BATCH_SIZE] for i in range(0, len(recipients), SMS_BATCH_SIZE)]
+    semaphore = asyncio.Semaphore(SMS_MAX_CONCURRENT_BATCHES)
+    
+    async def send_batch(batch: List[str]):
+        async with semaphore:
+            return await anyio.to_thread.run_sync(send_sms, message, batch, limiter=get_sms_thread_limiter())
+    
+    results = await asyncio.gather(*(send_batch(batch) for batch in batches), return_exceptions=True)
+    
+    batch_errors = []
+    batch_messages = []
+    sent_recipients = []
+    for batch, result in zip(batches, results):
+        if isinstance(result, dict) and 'SMSMessageData' in result:
+            batch_messages.append(result['SMSMessageData'].get('Message', ''))
+            sent_recipients.extend(result['SMSMessageData'].get('Recipients', []))
+            continue
+        
+        if isinstance(result, Exception):
+            logger.error(f"SMS batch of {len(batch)} recipients failed: {str(result)}")
+            batch_errors.append(result)
+            status_code = "BatchError"
+        else:
+            logger.error(f"Invalid SMS batch response: {result}")
+            batch_errors.append(ValueError(f"Invalid SMS gateway response: {result}"))
+            status_code = "InvalidResponse"
+        sent_recipients.extend(
+            {"number": number, "status": "Failed", "statusCode": status_code} for number in batch
+        )
+    
+    if batch_errors and len(batch_errors) == len(results):
+        raise batch_errors[0]
+    
+    return {
+        "SMSMessageData": {
+            "Message": "; ".join(batch_messages),
+            "Recipients": sent_recipients
+        }
+    }
+
+
+# Queued alert jobs (job_id -> status record), oldest evicted first
+ALERT_JOBS_MAX_SIZE = 10_000
+ALERT_JOB_MAX_FAILED_NUMBERS = 100
+alert_jobs: "OrderedDict[str, Dict]" = OrderedDict()
+
+
+def create_alert_job(job_type: str, **details) -> str:
+    """Record a queued alert job and return its ID"""
+    job_id = uuid.uuid4().hex
+    alert_jobs[job_id] = {
+        "job_id": job_id,
+        "type": job_type,
+        "status": "queued",
+        "created_at": datetime.now().isoformat(),
+        **details
+    }
+    while len(alert_jobs) > ALERT_JOBS_MAX_SIZE:
+        alert_jobs.popitem(last=False)
+    return job_id
 
 
-def send_alert_to_location(location: str, message: str) -> Dict:
+def summarize_alert_result(result: Dict) -> Dict:
+    """Reduce an alert result to its outcome, counts and the first few failed numbers for the job record"""
+    if "failed_sends" in result:
+        failed_numbers = [recipient["number"] for recipient in result["failed_sends"]]
+    else:
+        failed_numbers = result.get("failed_numbers", [])
+    return {
+        "message": result.get("message"),
+        "successful_count": result.get("successful_count", result.get("sent_count", 0)),
+        "failed_count": result.get("failed_count", len(failed_numbers)),
+        "failed_numbers": failed_numbers[:ALERT_JOB_MAX_FAILED_NUMBERS],  # Limit numbers kept
+        "has_more_failed": len(failed_numbers) > ALERT_JOB_MAX_FAILED_NUMBERS
+    }
+
+
+async def run_alert_job(job_id: str, send, *args):
+    """Run an alert send in the background and record its outcome on the job"""
+    job = alert_jobs.get(job_id, {})
+    job["status"] = "sending"
+    try:
+        result = await send(*args)
+        job["status"] = "failed" if result.get("status") == "error" else "completed"
+        job["result"] = summarize_alert_result(result)
+    except HTTPException as e:
+        job["status"] = "failed"
+        job["error"] = e.detail
+    except Exception as e:
+        logger.error(f"Alert job {job_id} failed: {str(e)}")
+        job["status"] = "failed"
+        job["error"] = str(e)
+    job["completed_at"] = datetime.now().isoformat()
+
+
+async def send_alert_to_location(location: str, message: str) -> Dict:
     """Send alert message to all users in a specific location"""
-    logger.info(f"Sending alert to location: {location}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"Sending alert to location: {location}")
     
     # Get users in the location
     users_in_location = get_users_by_location(location)
@@ -287,24 +1027,24 @@ def send_alert_to_location(location: str, message: str) -> Dict:
     
     try:
         # Send SMS using Africa's Talking
-        if AFRICAS_TALKING_SENDER_ID:
-            response = sms.send(
-                formatted_message, 
-                phone_numbers, 
-                sender_id=AFRICAS_TALKING_SENDER_ID
-            )
-        else:
-            response = sms.send(formatted_message, phone_numbers)
+        response = await send_sms_in_batches(formatted_message, phone_numbers)
         
-        logger.info(f"Location alert sent to {len(phone_numbers)} users in {location}")
+        # Recipients of batches the gateway rejected outright or answered with a malformed reply
+        failed_numbers = [
+            recipient['number'] for recipient in response['SMSMessageData']['Recipients']
+            if recipient.get('statusCode') in BATCH_FAILURE_CODES
+        ]
+        sent_count = len(phone_numbers) - len(failed_numbers)
+        
+        logger.info(f"Location alert sent to {sent_count} users in {location}")
         
         return {
-            "status": "success",
-            "message": f"Alert sent to {len(phone_numbers)} users in {location}",
-            "sent_count": len(phone_numbers),
-            "location": location,
-            "recipients": phone_numbers,
-            "response": response
+            "status": "success" if not failed_numbers else "partial",
+            "message": f"Alert sent to {sent_count} users in {location}",
+            "sent_count": sent_count,
+            "failed_count": len(failed_numbers),
+            "failed_numbers": failed_numbers,
+            "location": location
         }
         
     except Exception as e:
@@ -316,7 +1056,7 @@ def send_alert_to_location(location: str, message: str) -> Dict:
         }
 
 
-def register_user(phone_number: str, name: str, location: str) -> User:
+async def register_user(phone_number: str, name: str, location: str) -> User:
     """Register a new user in the system"""
     logger.info(f"Registering user: {name} ({phone_number}) in {location}")
     
@@ -326,17 +1066,32 @@ def register_user(phone_number: str, name: str, location: str) -> User:
         location=location
     )
     
-    users_db[phone_number] = user
+    store_user(user)
+    await save_user(user)
     logger.info(f"User {name} registered successfully")
     
     return user
 
 
+async def run_registration(phone_number: str, name: str, location: str):
+    """Run a USSD registration in the background, logging failures since the caller already got a reply"""
+    try:
+        await register_user(phone_number, name, location)
+    except Exception as e:
+        logger.error(f"Background registration for {phone_number} failed: {str(e)}")
+
+
 def get_user_by_phone(phone_number: str) -> Optional[User]:
     """Get user by phone number"""
     return users_db.get(phone_number)
 
 
+# Cap on per-user rows echoed back by a CSV upload (counts always cover every row)
+CSV_MAX_REPORTED_USERS = 1000
+# Rows validated and stored together during a CSV import
+CSV_IMPORT_BATCH_SIZE = 5000
+
+
 @app.post("/upload-users")
 async def upload_users_csv(file: UploadFile = File(...)):
     """
@@ -348,26 +1103,63 @@ async def upload_users_csv(file: UploadFile = File(...)):
         if not file.filename.endswith('.csv'):
             raise HTTPException(status_code=400, detail="File must be a CSV file")
         
-        # Read CSV content
-        content = await file.read()
-        csv_content = content.decode('utf-8')
-        
-        # Parse CSV
-        csv_reader = csv.DictReader(io.StringIO(csv_content))
-        
-        # Validate CSV headers
-        expected_headers = {'name', 'phone', 'location'}
-        if not expected_headers.issubset(set(csv_reader.fieldnames)):
-            raise HTTPException(
-                status_code=400, 
-                detail=f"CSV must contain headers: {', '.join(expected_headers)}. Found: {', '.join(csv_reader.fieldnames)}"
-            )
-        
-        # Process users
-        imported_users = []
-        errors = []
-        duplicate_count = 0
+        # Stream the spooled upload straight into the CSV parser (no full read into memory);
+        # wrapping SpooledTemporaryFile in TextIOWrapper needs Python 3.11+ (see runtime.txt)
+        text_stream = io.TextIOWrapper(file.file, encoding='utf-8', newline='')
+        try:
+            return await import_users_from_csv(csv.DictReader(text_stream))
+        finally:
+            # Leave closing the underlying upload file to FastAPI
+            text_stream.detach()
         
+    except HTTPException:
+        raise
+    except UnicodeDecodeError:
+        # Bad bytes in the header row, before anything was imported
+        raise HTTPException(status_code=400, detail="File must be UTF-8 encoded")
+    except Exception as e:
+        logger.error(f"Error uploading CSV: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error processing CSV: {str(e)}")
+
+
+async def import_users_from_csv(csv_reader: csv.DictReader) -> Dict:
+    """Register users from parsed CSV rows and build the upload summary"""
+    # Validate CSV headers
+    expected_headers = {'name', 'phone', 'location'}
+    fieldnames = csv_reader.fieldnames or []
+    if not expected_headers.issubset(set(fieldnames)):
+        raise HTTPException(
+            status_code=400, 
+            detail=f"CSV must contain headers: {', '.join(expected_headers)}. Found: {', '.join(fieldnames)}"
+        )
+    
+    # Process users
+    imported_users = []
+    imported_count = 0
+    errors = []
+    duplicate_count = 0
+    pending_rows: List[Dict] = []
+    pending_phones = set()
+    # One registration timestamp for the whole import instead of a clock read per user
+    registration_date = datetime.now().isoformat()
+    
+    async def register_pending():
+        """Validate, store and persist the pending rows as one batch"""
+        nonlocal imported_count
+        users = USER_LIST_ADAPTER.validate_python(pending_rows)
+        for user in users:
+            store_user(user)
+        await save_users(users)
+        imported_count += len(users)
+        room = CSV_MAX_REPORTED_USERS - len(imported_users)
+        if room > 0:
+            imported_users.extend(users_json_cache[user.phone_number] for user in users[:room])
+        pending_rows.clear()
+        pending_phones.clear()
+    
+    # Rows are decoded as they are read, so a bad byte can surface mid-file
+    row_num = 1
+    try:
         for row_num, row in enumerate(csv_reader, start=2):  # Start at 2 because row 1 is headers
             try:
                 name = row['name'].strip()
@@ -379,76 +1171,79 @@ async def upload_users_csv(file: UploadFile = File(...)):
                     errors.append(f"Row {row_num}: Missing required fields")
                     continue
                 
-                # Basic phone validation
-                if not phone.startswith('+'):
-                    errors.append(f"Row {row_num}: Phone number must include country code (e.g., +254...)")
+                # Phone validation (international format)
+                if not PHONE_NUMBER_PATTERN.fullmatch(phone):
+                    errors.append(f"Row {row_num}: Phone number must be in international format (e.g., +254712345678)")
                     continue
                 
-                # Check for duplicates
-                if phone in users_db:
+                # Check for duplicates (already registered or earlier in this file)
+                if phone in users_db or phone in pending_phones:
                     duplicate_count += 1
-                    logger.info(f"User {phone} already exists, skipping")
                     continue
                 
-                # Register user
-                user = register_user(phone, name, location)
-                imported_users.append({
-                    "name": user.name,
-                    "phone": user.phone_number,
-                    "location": user.location,
-                    "registration_date": user.registration_date
+                # Queue user for batch registration
+                pending_rows.append({
+                    "phone_number": phone,
+                    "name": name,
+                    "location": location,
+                    "registration_date": registration_date
                 })
+                pending_phones.add(phone)
                 
             except Exception as e:
                 errors.append(f"Row {row_num}: {str(e)}")
-        
-        logger.info(f"CSV upload completed: {len(imported_users)} users imported, {len(errors)} errors, {duplicate_count} duplicates")
-        
-        return {
-            "message": "CSV upload completed",
-            "imported_count": len(imported_users),
-            "error_count": len(errors),
-            "duplicate_count": duplicate_count,
-            "total_users_now": len(users_db),
-            "imported_users": imported_users,
-            "errors": errors[:10] if errors else [],  # Limit errors shown
-            "has_more_errors": len(errors) > 10
-        }
-        
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Error uploading CSV: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error processing CSV: {str(e)}")
+                continue
+            
+            if len(pending_rows) >= CSV_IMPORT_BATCH_SIZE:
+                await register_pending()
+    
+    except UnicodeDecodeError as e:
+        # Keep the rows read before the bad byte, and report how far the import got
+        if pending_rows:
+            await register_pending()
+        logger.error(f"CSV upload stopped after row {row_num}: {str(e)}")
+        raise HTTPException(
+            status_code=400,
+            detail={
+                "error": f"File must be UTF-8 encoded; invalid bytes after row {row_num}",
+                "failed_after_row": row_num,
+                "imported_count": imported_count,
+                "total_users_now": len(users_db)
+            }
+        )
+    
+    if pending_rows:
+        await register_pending()
+    
+    logger.info(f"CSV upload completed: {imported_count} users imported, {len(errors)} errors, {duplicate_count} duplicates")
+    
+    return {
+        "message": "CSV upload completed",
+        "imported_count": imported_count,
+        "error_count": len(errors),
+        "duplicate_count": duplicate_count,
+        "total_users_now": len(users_db),
+        "imported_users": imported_users,
+        "has_more_imported_users": imported_count > len(imported_users),
+        "errors": errors[:10] if errors else [],  # Limit errors shown
+        "has_more_errors": len(errors) > 10
+    }
 
 
 @app.get("/users")
-async def get_all_users():
-    """Get all registered users"""
+def get_all_users(include_users: bool = True):
+    """Get all registered users (include_users=false returns only the location summary)"""
     try:
-        users_list = []
-        for phone, user in users_db.items():
-            users_list.append({
-                "name": user.name,
-                "phone": user.phone_number,
-                "location": user.location,
-                "registration_date": user.registration_date
-            })
-        
-        # Group users by location for summary
-        location_summary = {}
-        for user in users_list:
-            location = user['location']
-            if location not in location_summary:
-                location_summary[location] = 0
-            location_summary[location] += 1
+        # Pre-serialized at registration; list() snapshots it as this runs in the threadpool
+        users_list = list(users_json_cache.values()) if include_users else []
         
-        return {
-            "total_users": len(users_list),
+        # Returned as a response directly so the (potentially large) list skips jsonable_encoder
+        return ORJSONResponse({
+            "total_users": len(users_db),
             "users": users_list,
-            "location_summary": location_summary,
-            "last_updated": datetime.now().isoformat()
-        }
+            "location_summary": dict(location_counts),
+            "last_updated": datetime.now()
+        })
         
     except Exception as e:
         logger.error(f"Error fetching users: {str(e)}")
@@ -456,37 +1251,40 @@ async def get_all_users():
 
 
 @app.get("/users/location/{location}")
-async def get_users_by_location_endpoint(location: str):
+def get_users_by_location_endpoint(location: str):
     """Get all users in a specific location"""
     try:
         users_in_location = get_users_by_location(location)
         
-        users_list = []
-        for user in users_in_location:
-            users_list.append({
-                "name": user.name,
-                "phone": user.phone_number,
-                "location": user.location,
-                "registration_date": user.registration_date
-            })
+        users_list = [users_json_cache[user.phone_number] for user in users_in_location]
         
-        return {
+        return ORJSONResponse({
             "location": location,
             "user_count": len(users_list),
             "users": users_list
-        }
+        })
         
     except Exception as e:
         logger.error(f"Error fetching users for location {location}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching users: {str(e)}")
 
 
-@app.post("/send-location-alert")
+@app.get("/alert-status/{job_id}")
+async def get_alert_status(job_id: str):
+    """Get the status and outcome of a queued alert"""
+    job = alert_jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Alert job {job_id} not found")
+    return job
+
+
+@app.post("/send-location-alert", status_code=202)
 async def send_location_alert_endpoint(
+    background_tasks: BackgroundTasks,
     location: str = Form(...),
     message: str = Form(...)
 ):
-    """Send alert to all users in a specific location"""
+    """Queue an alert to all users in a specific location; poll /alert-status/{job_id} for the outcome"""
     try:
         # Validate message
         if not message or not message.strip():
@@ -495,10 +1293,17 @@ async def send_location_alert_endpoint(
         if len(message.strip()) > 140:  # Leave room for location prefix
             raise HTTPException(status_code=400, detail="Message too long (max 140 characters)")
         
-        # Send the alert
-        result = send_alert_to_location(location, message.strip())
+        # Queue the alert
+        job_id = create_alert_job("location_alert", location=location)
+        background_tasks.add_task(run_alert_job, job_id, send_alert_to_location, location, message.strip())
         
-        return result
+        return {
+            "message": f"Alert to {location} queued",
+            "job_id": job_id,
+            "status": "queued",
+            "status_url": f"/alert-status/{job_id}",
+            "location": location
+        }
         
     except HTTPException:
         raise
@@ -508,7 +1313,7 @@ async def send_location_alert_endpoint(
 
 
 @app.get("/")
-async def root():
+def root():
     """Root endpoint with system overview"""
     user_count = len(users_db)
     report_count = len(emergency_reports)
@@ -533,40 +1338,48 @@ async def root():
             "upload_users": "/upload-users",
             "users": "/users",
             "location_alert": "/send-location-alert",
+            "alert_status": "/alert-status/{job_id}",
             "emergency_reports": "/emergency-reports"
         }
     }
 
 
-@app.post("/send-alert")
-async def send_alert(alert_request: AlertRequest):
+@app.post("/send-alert", status_code=202)
+async def send_alert(alert_request: AlertRequest, background_tasks: BackgroundTasks):
+    """
+    Queue an SMS alert to multiple recipients; poll /alert-status/{job_id} for the outcome
+    """
+    job_id = create_alert_job("alert", total_recipients=len(alert_request.recipients))
+    background_tasks.add_task(run_alert_job, job_id, dispatch_alert, alert_request.message, alert_request.recipients)
+    
+    return {
+        "message": "Alert queued",
+        "job_id": job_id,
+        "status": "queued",
+        "status_url": f"/alert-status/{job_id}",
+        "total_recipients": len(alert_request.recipients)
+    }
+
+
+async def dispatch_alert(message: str, recipients: List[str]) -> Dict:
     """
     Send SMS alert to multiple recipients
     """
     try:
         # Prepare the message with KASA branding
-        formatted_message = f"[KASA ALERT] {alert_request.message}"
+        formatted_message = f"[KASA ALERT] {message}"
         
-        logger.info(f"Attempting to send SMS to {len(alert_request.recipients)} recipients")
-        logger.info(f"Message: {formatted_message}")
-        logger.info(f"Recipients: {alert_request.recipients}")
-        logger.info(f"Sender ID: {AFRICAS_TALKING_SENDER_ID}")
+        logger.info(f"Attempting to send SMS to {len(recipients)} recipients")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Message: {formatted_message}")
+            logger.debug(f"Recipients: {recipients}")
+            logger.debug(f"Sender ID: {AFRICAS_TALKING_SENDER_ID}")
         
         # Send SMS using Africa's Talking
-        # Only include sender_id if it's not empty (sandbox doesn't allow custom sender IDs)
-        if AFRICAS_TALKING_SENDER_ID:
-            response = sms.send(
-                formatted_message, 
-                alert_request.recipients, 
-                sender_id=AFRICAS_TALKING_SENDER_ID
-            )
-        else:
-            response = sms.send(
-                formatted_message, 
-                alert_request.recipients
-            )
+        response = await send_sms_in_batches(formatted_message, recipients)
         
-        logger.info(f"Africa's Talking response: {response}")
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"Africa's Talking response: {response}")
         
         # Process the response
         if response and 'SMSMessageData' in response and response['SMSMessageData']['Recipients']:
@@ -594,7 +1407,7 @@ async def send_alert(alert_request: AlertRequest):
                 "message": "Alert processing completed",
                 "successful_sends": successful_sends,
                 "failed_sends": failed_sends,
-                "total_recipients": len(alert_request.recipients),
+                "total_recipients": len(recipients),
                 "successful_count": len(successful_sends),
                 "failed_count": len(failed_sends),
                 "debug_info": {
@@ -642,6 +1455,7 @@ async def send_alert(alert_request: AlertRequest):
 
 @app.post("/ussd", response_class=PlainTextResponse)
 async def ussd_handler(
+    background_tasks: BackgroundTasks,
     sessionId: str = Form(...),
     serviceCode: str = Form(...),
     phoneNumber: str = Form(...),
@@ -651,25 +1465,29 @@ async def ussd_handler(
     Handle USSD requests from Africa's Talking with session state management
     """
     try:
-        logger.info(f"USSD request - Session: {sessionId}, Phone: {phoneNumber}, Text: '{text}'")
+        # Normalized once here; the registration flow and emergency reports key on this value
+        phoneNumber = canonical_phone(phoneNumber)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"USSD request - Session: {sessionId}, Phone: {phoneNumber}, Text: '{text}'")
         
         # Get current session state
-        session_data = ussd_session_manager.get_session(sessionId)
-        
-        # Split the text by '*' to get user's navigation path
-        text_array = text.split('*') if text else ['']
+        session_data = await ussd_session_manager.get_session(sessionId)
         
         # Check if we're in a registration flow
         if session_data.get('flow') == 'registration':
-            return await handle_registration_flow(sessionId, phoneNumber, text, text_array, session_data)
+            return await handle_registration_flow(sessionId, phoneNumber, text, session_data, background_tasks)
+        
+        # Navigation depth of the '*'-separated path (read by index, no list allocation)
+        depth = text.count('*') + 1
+        first_sep = text.find('*')
         
         # Main menu (when user first dials or selects 0)
         if text == '' or text == '0':
-            ussd_session_manager.clear_session(sessionId)
+            await ussd_session_manager.clear_session(sessionId)
             return USSDSession.get_main_menu()
         
         # First level navigation
-        elif len(text_array) == 1:
+        elif depth == 1:
             if text == '1':  # Send Emergency Alert
                 return USSDSession.get_emergency_menu()
             elif text == '2':  # Register User
@@ -682,7 +1500,7 @@ async def ussd_handler(
                            f"Registered: {existing_user.registration_date[:10]}")
                 
                 # Start registration flow
-                ussd_session_manager.set_session(sessionId, {
+                await ussd_session_manager.set_session(sessionId, {
                     'flow': 'registration',
                     'step': 'name',
                     'phone': phoneNumber
@@ -702,37 +1520,26 @@ async def ussd_handler(
                 return "END Invalid option. Please try again."
         
         # Second level navigation
-        elif len(text_array) == 2:
-            if text_array[0] == '1':  # Emergency alert selected
-                emergency_types = {
-                    '1': 'Fire Emergency',
-                    '2': 'Medical Emergency', 
-                    '3': 'Security Alert',
-                    '4': 'Natural Disaster'
-                }
-                
-                if text_array[1] in emergency_types:
-                    alert_type = emergency_types[text_array[1]]
+        elif depth == 2:
+            first, second = text[:first_sep], text[first_sep + 1:]
+            if first == '1':  # Emergency alert selected
+                if second in EMERGENCY_TYPES:
+                    alert_type = EMERGENCY_TYPES[second]
                     return USSDSession.get_confirmation_menu(alert_type)
-                elif text_array[1] == '0':
+                elif second == '0':
                     return USSDSession.get_main_menu()
                 else:
                     return "END Invalid emergency type."
             
-            elif text_array[0] == '4' and text_array[1] == '0':  # Back from help
+            elif first == '4' and second == '0':  # Back from help
                 return USSDSession.get_main_menu()
         
         # Third level navigation (confirmation)
-        elif len(text_array) == 3:
-            if text_array[0] == '1' and text_array[2] == '1':  # Confirm alert
-                emergency_types = {
-                    '1': 'Fire Emergency',
-                    '2': 'Medical Emergency',
-                    '3': 'Security Alert', 
-                    '4': 'Natural Disaster'
-                }
-                
-                alert_type = emergency_types.get(text_array[1])
+        elif depth == 3:
+            second_sep = text.find('*', first_sep + 1)
+            first, second, third = text[:first_sep], text[first_sep + 1:second_sep], text[second_sep + 1:]
+            if first == '1' and third == '1':  # Confirm alert
+                alert_type = EMERGENCY_TYPES.get(second)
                 if alert_type:
                     # Get user info if registered
                     user = get_user_by_phone(phoneNumber)
@@ -758,128 +1565,155 @@ async def ussd_handler(
                         status="pending"
                     )
                     
-                    # Store the report in in-memory storage
-                    emergency_reports[reference_id] = report
+                    # Store the report in memory and persist it
+                    store_emergency_report(report)
+                    await save_emergency_report(report)
                     
-                    # Send alert to registered users in the same area (if user is registered)
-                    location_alert_result = None
+                    # Alert registered users in the same area (if user is registered) after responding
+                    local_user_count = 0
                     if user:
+                        local_user_count = len(users_by_location_idx.get(user.location.lower(), ()))
                         alert_message = f"EMERGENCY ALERT: {alert_type} reported in {user.location}. From: {user.name} ({phoneNumber}). Stay alert and safe!"
-                        location_alert_result = send_alert_to_location(user.location, alert_message)
+                        job_id = create_alert_job("location_alert", location=user.location, reference_id=reference_id)
+                        background_tasks.add_task(run_alert_job, job_id, send_alert_to_location, user.location, alert_message)
                     
                     # Clear session
-                    ussd_session_manager.clear_session(sessionId)
+                    await ussd_session_manager.clear_session(sessionId)
                     
                     response_msg = (f"END {alert_type} alert sent!\n"
                                   f"Reference: {reference_id}\n"
                                   f"Location: {location_info}")
                     
-                    if location_alert_result and location_alert_result['status'] == 'success':
-                        response_msg += f"\n✓ {location_alert_result['sent_count']} local users notified"
+                    if local_user_count:
+                        response_msg += f"\n✓ {local_user_count} local users being notified"
                     
                     response_msg += "\nStay safe!"
                     
                     return response_msg
                 
-            elif text_array[0] == '1' and text_array[2] == '2':  # Cancel alert
-                ussd_session_manager.clear_session(sessionId)
+            elif first == '1' and third == '2':  # Cancel alert
+                await ussd_session_manager.clear_session(sessionId)
                 return "END Alert cancelled. Stay safe!"
             
-            elif text_array[0] == '1' and text_array[2] == '0':  # Back to main menu
+            elif first == '1' and third == '0':  # Back to main menu
                 return USSDSession.get_main_menu()
         
         # Default response for unhandled cases
-        ussd_session_manager.clear_session(sessionId)
+        await ussd_session_manager.clear_session(sessionId)
         return "END Session ended. Dial again to restart."
         
     except Exception as e:
         logger.error(f"Error handling USSD request: {str(e)}")
-        ussd_session_manager.clear_session(sessionId)
+        await ussd_session_manager.clear_session(sessionId)
         return "END System error. Please try again later."
 
 
-async def handle_registration_flow(session_id: str, phone_number: str, text: str, text_array: List[str], session_data: Dict) -> str:
+async def handle_name_step(session_id: str, phone_number: str, text: str, name: Optional[str],
+                           location: Optional[str], background_tasks: BackgroundTasks) -> str:
+    """Registration step 1: collect the user's name"""
+    if text and text.strip():
+        # User entered their name
+        name = text.strip()
+        await ussd_session_manager.update_session(session_id, {'name': name, 'step': 'location'})
+        return USSDSession.get_registration_location_prompt(name)
+    else:
+        return "CON Please enter your full name:"
+
+
+async def handle_location_step(session_id: str, phone_number: str, text: str, name: Optional[str],
+                               location: Optional[str], background_tasks: BackgroundTasks) -> str:
+    """Registration step 2: collect the user's location"""
+    if text and text.strip():
+        # User entered their location
+        location = text.strip()
+        await ussd_session_manager.update_session(session_id, {'location': location, 'step': 'confirmation'})
+        return USSDSession.get_registration_confirmation(name, location)
+    else:
+        return "CON Please enter your location/area:"
+
+
+async def confirm_registration(session_id: str, phone_number: str, name: Optional[str], location: Optional[str],
+                               background_tasks: BackgroundTasks) -> str:
+    """Confirmation option 1: register the user"""
+    # Register the user (storage and persistence) after the gateway gets its response
+    background_tasks.add_task(run_registration, phone_number, name, location)
+    
+    # Clear session
+    await ussd_session_manager.clear_session(session_id)
+    
+    return (f"END Registration successful!\n"
+           f"Name: {name}\n"
+           f"Location: {location}\n"
+           f"Phone: {phone_number}\n"
+           f"You can now receive location alerts!")
+
+
+async def cancel_registration(session_id: str, phone_number: str, name: Optional[str], location: Optional[str],
+                              background_tasks: BackgroundTasks) -> str:
+    """Confirmation option 2: cancel registration"""
+    await ussd_session_manager.clear_session(session_id)
+    return "END Registration cancelled."
+
+
+async def back_to_main_menu(session_id: str, phone_number: str, name: Optional[str], location: Optional[str],
+                            background_tasks: BackgroundTasks) -> str:
+    """Confirmation option 0: back to main menu"""
+    await ussd_session_manager.clear_session(session_id)
+    return USSDSession.get_main_menu()
+
+
+# Confirmation screen option -> action
+CONFIRM_ACTIONS = {
+    '1': confirm_registration,
+    '2': cancel_registration,
+    '0': back_to_main_menu,
+}
+
+
+async def handle_confirmation_step(session_id: str, phone_number: str, text: str, name: Optional[str],
+                                   location: Optional[str], background_tasks: BackgroundTasks) -> str:
+    """Registration step 3: confirm, cancel or go back to the main menu"""
+    action = CONFIRM_ACTIONS.get(text)
+    if action is not None:
+        return await action(session_id, phone_number, name, location, background_tasks)
+    
+    # Invalid option, show confirmation again
+    return USSDSession.get_registration_confirmation(name, location)
+
+
+# Registration step -> handler, looked up once per USSD hop
+STEP_HANDLERS = {
+    'name': handle_name_step,
+    'location': handle_location_step,
+    'confirmation': handle_confirmation_step,
+}
+
+
+async def handle_registration_flow(session_id: str, phone_number: str, text: str, session_data: Dict,
+                                   background_tasks: BackgroundTasks) -> str:
     """Handle the multi-step user registration flow"""
     try:
-        step = session_data.get('step')
-        
-        if step == 'name':
-            if text and text.strip():
-                # User entered their name
-                name = text.strip()
-                ussd_session_manager.update_session(session_id, 'name', name)
-                ussd_session_manager.update_session(session_id, 'step', 'location')
-                return USSDSession.get_registration_location_prompt(name)
-            else:
-                return "CON Please enter your full name:"
-        
-        elif step == 'location':
-            if text and text.strip():
-                # User entered their location
-                location = text.strip()
-                name = session_data.get('name')
-                ussd_session_manager.update_session(session_id, 'location', location)
-                ussd_session_manager.update_session(session_id, 'step', 'confirmation')
-                return USSDSession.get_registration_confirmation(name, location)
-            else:
-                return "CON Please enter your location/area:"
-        
-        elif step == 'confirmation':
-            if text == '1':  # Confirm registration
-                name = session_data.get('name')
-                location = session_data.get('location')
-                
-                # Register the user
-                user = register_user(phone_number, name, location)
-                
-                # Clear session
-                ussd_session_manager.clear_session(session_id)
-                
-                return (f"END Registration successful!\n"
-                       f"Name: {name}\n"
-                       f"Location: {location}\n"
-                       f"Phone: {phone_number}\n"
-                       f"You can now receive location alerts!")
-            
-            elif text == '2':  # Cancel registration
-                ussd_session_manager.clear_session(session_id)
-                return "END Registration cancelled."
-            
-            elif text == '0':  # Back to main menu
-                ussd_session_manager.clear_session(session_id)
-                return USSDSession.get_main_menu()
-            
-            else:
-                # Invalid option, show confirmation again
-                name = session_data.get('name')
-                location = session_data.get('location')
-                return USSDSession.get_registration_confirmation(name, location)
+        # Read the session fields once; every step works from these
+        handler = STEP_HANDLERS.get(session_data.get('step'))
+        name = session_data.get('name')
+        location = session_data.get('location')
+        if handler is not None:
+            return await handler(session_id, phone_number, text, name, location, background_tasks)
         
         # If we get here, something went wrong
-        ussd_session_manager.clear_session(session_id)
+        await ussd_session_manager.clear_session(session_id)
         return "END Registration error. Please try again."
         
     except Exception as e:
         logger.error(f"Error in registration flow: {str(e)}")
-        ussd_session_manager.clear_session(session_id)
+        await ussd_session_manager.clear_session(session_id)
         return "END Registration error. Please try again later."
 
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    try:
-        # You could add more comprehensive health checks here
-        # like checking Africa's Talking API connectivity
-        return {
-            "status": "healthy",
-            "service": "KASA Alert System",
-            "timestamp": "2025-06-27",
-            "africas_talking": "configured" if AFRICAS_TALKING_USERNAME else "not_configured"
-        }
-    except Exception as e:
-        logger.error(f"Health check failed: {str(e)}")
-        raise HTTPException(status_code=503, detail="Service unhealthy")
+    return Response(content=HEALTH_BYTES, media_type="application/json")
 
 
 @app.get("/test-sms-credentials")
@@ -887,80 +1721,32 @@ async def test_sms_credentials():
     """
     Test SMS credentials without sending actual messages
     """
-    try:
-        # Try to initialize the SMS service (this validates credentials)
-        test_sms = africastalking.SMS
-        
-        return {
-            "status": "success",
-            "message": "SMS credentials are valid",
-            "config": {
-                "username": AFRICAS_TALKING_USERNAME,
-                "api_key_configured": bool(AFRICAS_TALKING_API_KEY),
-                "sender_id": AFRICAS_TALKING_SENDER_ID,
-                "environment": "sandbox" if AFRICAS_TALKING_USERNAME == "sandbox" else "production"
-            },
-            "sandbox_info": {
-                "note": "For sandbox testing, use test numbers from your dashboard",
-                "common_test_formats": ["+254711XXXXXX", "+254733XXXXXX"],
-                "dashboard_url": "https://account.africastalking.com/"
-            }
-        }
-    except Exception as e:
-        logger.error(f"SMS credentials test failed: {str(e)}")
-        raise HTTPException(
-            status_code=500,
-            detail={
-                "status": "failed",
-                "error": str(e),
-                "help": "Check your Africa's Talking credentials in the .env file"
-            }
-        )
+    # The SMS service was initialized with these credentials at import
+    return Response(content=SMS_CREDENTIALS_BYTES, media_type="application/json")
 
 
 @app.get("/test-credentials")
 async def test_credentials():
     """Test Africa's Talking credentials without sending SMS"""
-    try:
-        return {
-            "username": AFRICAS_TALKING_USERNAME,
-            "api_key_preview": f"{AFRICAS_TALKING_API_KEY[:10]}..." if AFRICAS_TALKING_API_KEY else "None",
-            "sender_id": AFRICAS_TALKING_SENDER_ID,
-            "credentials_loaded": bool(AFRICAS_TALKING_USERNAME and AFRICAS_TALKING_API_KEY)
-        }
-    except Exception as e:
-        logger.error(f"Error checking credentials: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error checking credentials: {str(e)}")
+    return Response(content=CREDENTIALS_BYTES, media_type="application/json")
 
 
 @app.get("/emergency-reports")
-async def get_emergency_reports():
-    """Get all emergency reports for emergency services dashboard"""
+async def get_emergency_reports(status: Optional[str] = None, location: Optional[str] = None,
+                                since: Optional[datetime] = None, limit: int = 100):
+    """Get emergency reports for emergency services dashboard, newest first, optionally filtered"""
+    if limit < 1:
+        raise HTTPException(status_code=400, detail="limit must be at least 1")
     try:
-        reports = []
-        for ref_id, report in emergency_reports.items():
-            reports.append({
-                "reference_id": ref_id,
-                "emergency_type": report.emergency_type,
-                "phone_number": report.phone_number,
-                "timestamp": report.timestamp,
-                "location": {
-                    "address": report.location.address,
-                    "landmark": report.location.landmark,
-                    "latitude": report.location.latitude,
-                    "longitude": report.location.longitude,
-                    "cell_tower": report.location.cell_tower_id,
-                    "network": report.location.network_provider,
-                    "maps_link": f"https://maps.google.com/?q={report.location.latitude},{report.location.longitude}" if report.location.latitude and report.location.longitude else None
-                },
-                "status": report.status
-            })
+        # Only the page of `limit` reports is serialized; ORJSONResponse skips jsonable_encoder
+        total, reports = query_emergency_reports(status, location, since, limit)
         
-        return {
-            "total_reports": len(reports),
+        return ORJSONResponse({
+            "total_reports": total,
+            "returned_reports": len(reports),
             "reports": reports,
             "last_updated": "2025-06-28T14:30:00Z"
-        }
+        })
     except Exception as e:
         logger.error(f"Error fetching emergency reports: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error fetching reports: {str(e)}")
@@ -976,6 +1762,8 @@ async def register_user_location(
 ):
     """Allow users to register their location for emergencies"""
     try:
+        phone_number = canonical_phone(phone_number)
+        
         # In production, store this in a database
         user_location = LocationInfo(
             latitude=latitude,
@@ -985,10 +1773,7 @@ async def register_user_location(
         )
         
         # Store in memory (use database in production)
-        if not hasattr(register_user_location, 'user_locations'):
-            register_user_location.user_locations = {}
-        
-        register_user_location.user_locations[phone_number] = user_location
+        USER_LOCATIONS.set(phone_number, user_location)
         
         logger.info(f"Location registered for {phone_number}: {address}")
         